@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from functools import cache
@@ -6,10 +7,15 @@ import gspread
 import pydantic
 import yaml
 from icontract import ensure
+from requests.adapters import HTTPAdapter
 from reretry import retry
 
 from settings import Setting
 
+_FIELD_NAMES = tuple(Setting.model_fields)
+_FIELD_INDEX = {field: i for i, field in enumerate(_FIELD_NAMES)}
+_LAST_COLUMN = chr(ord("A") + len(_FIELD_NAMES) - 1)
+
 
 class Client(pydantic.BaseModel, extra="allow"):
     name: str
@@ -18,25 +24,33 @@ class Client(pydantic.BaseModel, extra="allow"):
     alert_account: str | int
 
     def load_settings(self) -> list[Setting]:
-        data = get_worksheet(self.spreadsheet_url).get_all_values()
-        fields = list(Setting.model_fields.keys())
+        # Only fetch the columns that map to Setting fields
+        sheet = get_worksheet(self.spreadsheet_url)
+        data = sheet.get_values(f"A1:{_LAST_COLUMN}")
 
-        self.settings = [Setting(**dict(zip(fields, row))) for row in data[1:]]
+        self.settings = [
+            Setting.model_validate(dict(zip(_FIELD_NAMES, row))) for row in data[1:]
+        ]
 
         self.check_for_duplicate_chat_ids()
 
         return self.settings
 
+    async def load_settings_async(self) -> list[Setting]:
+        """Run `load_settings` in a worker thread so that the event loop
+        is not blocked while waiting for Google Sheets."""
+        return await asyncio.to_thread(self.load_settings)
+
     def check_for_duplicate_chat_ids(self):
-        # store duplicate chat_ids in a list
-        processed = []
+        # store processed chat_ids in a set for O(1) lookups
+        processed = set()
         for setting in self.settings:
             key = (setting.chat_id, setting.text)
             if key in processed:
                 setting.error = "Error: Повторяющееся название чата и сообщение"
                 setting.active = 0
             else:
-                processed.append(key)  # add to list if not duplicate
+                processed.add(key)  # add to set if not duplicate
 
     def update_settings_in_gsheets(self, fields: list[str]):
         """Get data from self.settings and write it to corresponding columns in Google Sheets.
@@ -50,12 +64,20 @@ class Client(pydantic.BaseModel, extra="allow"):
         if isinstance(fields, str):
             fields = [fields]
 
+        # Send all columns in a single request instead of one per field
+        body = []
         for field in fields:
-            col_num = list(Setting.model_fields.keys()).index(field)
+            col_num = _FIELD_INDEX[field]
             col_letter = chr(ord("A") + col_num)
             range_str = f"{col_letter}2:{col_letter}{len(self.settings) + 1}"
             data = [[getattr(setting, field)] for setting in self.settings]
-            sheet.update(range_str, data)
+            body.append({"range": range_str, "values": data})
+
+        sheet.batch_update(body)
+
+    async def update_settings_in_gsheets_async(self, fields: list[str]):
+        """Run `update_settings_in_gsheets` in a worker thread."""
+        await asyncio.to_thread(self.update_settings_in_gsheets, fields)
 
 
 def load_clients():
@@ -79,4 +101,10 @@ def get_worksheet(spreadsheet_url) -> gspread.Worksheet:
 def get_google_client():
     service_string = os.environ["GOOGLE_SERVICE_ACCOUNT"]
     service_dict = json.loads(service_string)
-    return gspread.service_account_from_dict(service_dict)
+    client = gspread.service_account_from_dict(service_dict)
+
+    # Keep connections alive across all sheet operations of all clients
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+    client.http_client.session.mount("https://", adapter)
+
+    return client
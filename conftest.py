@@ -0,0 +1,19 @@
+import pytest
+
+from settings import Setting
+
+
+@pytest.fixture
+def make_setting():
+    """Factory for active settings of one account that differ by chat and text"""
+
+    def make(chat_id="chat_1", text="Hello"):
+        return Setting(
+            active=1,
+            account="79234567890",
+            schedule="0 * * * *",
+            chat_id=chat_id,
+            text=text,
+        )
+
+    return make
@@ -37,19 +37,28 @@ async def validate_accs(settings, fs):
         setting.account for setting in settings if setting.active
     } | {os.environ["ALERT_ACCOUNT"]}
 
+    # Accounts are validated one by one: revalidation may prompt for
+    # a login code and prompts for different accounts must not interleave
     for account in distinct_account_ids:
-        print("Проверка аккаунта", to_phone_format(account))
-        while True:
-            try:
-                async with Account(fs, account).session(revalidate=True):
-                    print("OK")
-                    break
-            except (PasswordHashInvalid, PhoneCodeInvalid):
-                print("Некорректно")
-            except FloodWait as e:
-                print(
-                    "Слишком много неправильных попыток. Подождите {humanized_seconds(e.value).}"
-                )
+        await validate_acc(account, fs)
+
+
+async def validate_acc(account, fs):
+    print("Проверка аккаунта", to_phone_format(account))
+    while True:
+        try:
+            async with Account(fs, account).session(revalidate=True):
+                print("OK")
+                return
+        except (PasswordHashInvalid, PhoneCodeInvalid):
+            print("Некорректно")
+        except FloodWait as e:
+            print(
+                "Слишком много неправильных попыток. "
+                f"Подождите {humanized_seconds(e.value)}."
+            )
+            await asyncio.sleep(e.value)
+
 
 def to_phone_format(s):
     # Transform a 11-digit string to a +X (XXX) XXX-XX-XX format
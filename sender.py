@@ -1,8 +1,12 @@
 import asyncio
+import concurrent.futures
+import contextlib
 import datetime
 import os
-import traceback
-from datetime import datetime
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from functools import cache
 
 import dotenv
 import pyrogram
@@ -13,6 +17,7 @@ from pyrogram.errors import (
     ChatSendMediaForbidden,
     ChatWriteForbidden,
     InviteRequestSent,
+    PeerIdInvalid,
     RPCError,
     SlowmodeWait,
 )
@@ -21,27 +26,50 @@ from tg.supabasefs import SupabaseTableFileSystem
 from tg.utils import parse_telegram_message_url
 
 from clients import Client, load_clients
-from settings import Setting
+from settings import Outcome, Setting
 from supabase_logs import SupabaseLogHandler
+from telegram_calls import RateLimiter, call_with_retries
 from yandex_logging import init_logging
 
 logger = init_logging(__name__)
 
 
+# Limits shared by all accounts: the overall rate and per-chat spacing,
+# so that two accounts posting to the same chat are paced too
+shared_rate_limiter = RateLimiter(rate=30, capacity=1, chat_interval=1)
+
+
 class SenderAccount(Account):
     """Defines methods for sending and forwarding messages
-    with forced joining the group if the peer is not in the chat yet."""
+    with forced joining the group if the peer is not in the chat yet.
+    Calls are paced by a per-account and a shared rate limiter."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = RateLimiter()
+        self.peers = {}  # resolved peers by chat id
+
+    async def get_peer(self, chat_id):
+        if chat_id not in self.peers:
+            self.peers[chat_id] = await self.app.resolve_peer(chat_id)
+        return self.peers[chat_id]
+
+    async def wait_for_slot(self, chat_id):
+        await self.rate_limiter.acquire(chat_id)
+        await shared_rate_limiter.acquire(chat_id)
 
     async def send_message(self, chat_id, text):
         if not self.started:
             raise RuntimeError("App is not started")
 
+        await self.wait_for_slot(chat_id)
+
         try:
-            return await self.app.send_message(chat_id, text)
+            return await call_with_retries(self.app.send_message, chat_id, text)
 
         except ChatWriteForbidden:
-            await self.app.join_chat(chat_id)
-            return await self.app.send_message(chat_id, text)
+            await call_with_retries(self.app.join_chat, chat_id)
+            return await call_with_retries(self.app.send_message, chat_id, text)
 
     async def forward_message(self, chat_id, from_chat_id, message_id):
         """Forward message from chat to chat with forced joining the group
@@ -51,8 +79,11 @@ class SenderAccount(Account):
         if not self.started:
             raise RuntimeError("App is not started")
 
-        from_peer = await self.app.resolve_peer(from_chat_id)
-        to_peer = await self.app.resolve_peer(chat_id)
+        await self.wait_for_slot(chat_id)
+
+        from_peer, to_peer = await asyncio.gather(
+            self.get_peer(from_chat_id), self.get_peer(chat_id)
+        )
         wrapper = pyrogram.raw.functions.messages.forward_messages.ForwardMessages
         forward_messages_query = wrapper(
             from_peer=from_peer,
@@ -63,67 +94,143 @@ class SenderAccount(Account):
         )
 
         try:
-            return await self.app.invoke(forward_messages_query)
+            return await call_with_retries(self.app.invoke, forward_messages_query)
 
         except ChatWriteForbidden:
-            await self.app.join_chat(chat_id)
-            return await self.app.invoke(forward_messages_query)
+            await call_with_retries(self.app.join_chat, chat_id)
+            return await call_with_retries(self.app.invoke, forward_messages_query)
+
+        except PeerIdInvalid:
+            # Don't reuse peers that Telegram no longer accepts. This usually
+            # means the account has no access, so retrying would not help
+            self.peers.pop(from_chat_id, None)
+            self.peers.pop(chat_id, None)
+            raise
+
+
+_dotenv_loaded = False
 
 
 async def main():
-    dotenv.load_dotenv()
+    # The .env file only needs to be parsed once per process
+    global _dotenv_loaded
+    if not _dotenv_loaded:
+        dotenv.load_dotenv(override=False)
+        _dotenv_loaded = True
+
     fs = set_up_supabase()
     clients = load_clients()
 
-    for client in clients:
-        logger.info(f"Starting {client.name}")
-        await process_client(fs, client)
-        logger.info(f"Finished {client.name}")
+    # Owned by this run, so a cancelled run that is still unwinding
+    # flushes its own entries and never touches the next run's
+    logs = SupabaseLogHandler(get_env_supabase_client())
+
+    # Clients share Telegram accounts (e.g. the alert account),
+    # so they are processed one at a time unless configured otherwise
+    semaphore = asyncio.Semaphore(int(os.environ.get("SENDER_MAX_CLIENTS", 1)))
+
+    async def run(client: Client):
+        async with semaphore:
+            await process_client(fs, logs, client)
+
+    # One failing client should neither cancel nor hide the others
+    results = await asyncio.gather(
+        *[run(client) for client in clients], return_exceptions=True
+    )
+
+    for client, result in zip(clients, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed {client.name}", exc_info=result)
 
     logger.info("Messages sent and logged successfully")
 
 
 def set_up_supabase():
+    return SupabaseTableFileSystem(get_env_supabase_client(), "sessions")
 
-    global supabase_client, supabase_logs
 
-    supabase_client = supabase.create_client(
-        os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"]
-    )
+def get_env_supabase_client() -> supabase.Client:
+    return get_supabase_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"])
 
-    supabase_logs = SupabaseLogHandler(supabase_client)
 
-    return SupabaseTableFileSystem(supabase_client, "sessions")
+@cache
+def get_supabase_client(url: str, key: str) -> supabase.Client:
+    # One client per process: its pooled keep-alive connections
+    # are reused by every run of the handler
+    return supabase.create_client(url, key)
 
 
-async def process_client(fs, client: Client):
-    try:
-        errors = {}
+async def process_client(fs, logs: SupabaseLogHandler, client: Client):
+    logger.info(f"Starting {client.name}")
+
+    errors: dict[str, str] = {}
+    published = False
 
-        settings = client.load_settings()
+    try:
+        settings = await client.load_settings_async()
 
         if any(s.active for s in settings):
-            accounts = set_up_accounts(fs, settings)
-            supabase_logs.load_results_for_client(client.name)
-
-            async with accounts.session():
-                await asyncio.gather(
-                    *[
-                        process_setting_outer(client.name, setting, accounts, errors)
-                        for setting in settings
-                    ]
-                )
+            await asyncio.to_thread(logs.load_results_for_client, client.name)
+
+            # All checks use the same moment, so the settings found due here
+            # are exactly the ones that get sent below
+            now = datetime.now(tz=timezone.utc)
+            due = [s for s in settings if is_due(logs, client.name, s, now)]
+
+            # Don't start any Telegram sessions if there is nothing to send
+            accounts = set_up_accounts(fs, due) if due else None
+            session = accounts.session() if due else contextlib.nullcontext()
+
+            semaphore = asyncio.Semaphore(
+                int(os.environ.get("SENDER_MAX_PARALLEL_SENDS", 4))
+            )
+            alert_phone = str(client.alert_account)
+
+            try:
+                async with session:
+                    # A TaskGroup cancels the remaining queues if one of them
+                    # fails unexpectedly instead of leaving them running
+                    async with asyncio.TaskGroup() as tg:
+                        for account_settings in group_by_account(settings):
+                            tg.create_task(
+                                process_account_queue(
+                                    logs,
+                                    client.name,
+                                    account_settings,
+                                    accounts,
+                                    errors,
+                                    semaphore,
+                                    now,
+                                )
+                            )
+
+                    # Reuse the running session if the alert account
+                    # is also one of the sending accounts
+                    if any(s.account == alert_phone for s in due):
+                        await send_stats(errors, accounts[alert_phone], client)
+                        published = True
+            finally:
+                await asyncio.to_thread(logs.flush)
         else:
             logger.warning(f"No active settings for {client.name}")
 
     except AccountStartFailed as exc:
         errors[""] = f"Телефон {exc.phone} не был инициализирован."
-    except Exception:
-        errors[""] = f"Error: {traceback.format_exc()}"
+    except Exception as e:
+        # Report what failed inside the TaskGroup rather than the group itself
+        causes = e.exceptions if isinstance(e, ExceptionGroup) else [e]
+        errors[""] = "\n".join(f"Error: {type(c).__name__}: {c}" for c in causes)
+        logger.exception(
+            f"Error processing {client.name}", extra={"client_name": client.name}
+        )
+
+    # Also publish again if flushing the logs failed after the stats were sent
+    if not published or "" in errors:
+        await publish_stats(errors, fs, client)
 
-    await publish_stats(errors, fs, client)
+    await client.update_settings_in_gsheets_async(["active", "error"])
 
-    client.update_settings_in_gsheets(["active", "error"])
+    logger.info(f"Finished {client.name}")
 
 
 def set_up_accounts(fs, settings: list[Setting]):
@@ -138,37 +245,87 @@ def set_up_accounts(fs, settings: list[Setting]):
     )
 
 
+def group_by_account(settings: list[Setting]) -> list[list[Setting]]:
+    by_account = defaultdict(list)
+    for setting in settings:
+        by_account[setting.account].append(setting)
+    return list(by_account.values())
+
+
+async def process_account_queue(
+    logs: SupabaseLogHandler,
+    client_name: str,
+    settings: list[Setting],
+    accounts: AccountCollection,
+    errors: dict[str, str],
+    semaphore: asyncio.Semaphore,
+    now: datetime,
+):
+    """Process settings of a single account one by one, since Telegram
+    rate limits are per account. Different accounts run in parallel,
+    up to SENDER_MAX_PARALLEL_SENDS at a time."""
+    async with semaphore:
+        for setting in settings:
+            await process_setting_outer(
+                logs, client_name, setting, accounts, errors, now
+            )
+
+
+def is_due(
+    logs: SupabaseLogHandler, client_name: str, setting: Setting, now: datetime
+) -> bool:
+    """Return True if the setting is active and its message should be sent now"""
+    if not setting.active:
+        return False
+
+    successful = logs.get_last_successful_entry(client_name, setting)
+    return check_setting_time(setting, successful, now) is None
+
+
 async def process_setting_outer(
-    client_name: str, setting: Setting, accounts: AccountCollection, errors: list[str]
+    logs: SupabaseLogHandler,
+    client_name: str,
+    setting: Setting,
+    accounts: AccountCollection | None,
+    errors: dict[str, str],
+    now: datetime,
 ):
     if setting.active:
         try:
-            successful = supabase_logs.get_last_successful_entry(setting)
-            result = check_setting_time(setting, successful)
-            if not result:
-                result = await send_setting(setting, accounts)
-
-        except Exception:
-            result = f"Error: {traceback.format_exc()}"
+            successful = logs.get_last_successful_entry(client_name, setting)
+            checked = check_setting_time(setting, successful, now)
+            if not checked:
+                acc: SenderAccount = accounts[setting.account]
+                checked = await send_setting(setting, acc)
+            outcome, result = checked
+
+        except Exception as e:
+            outcome, result = Outcome.ERROR, f"Error: {type(e).__name__}: {e}"
+            logger.exception(
+                f"Error processing {setting}",
+                extra={
+                    "client_name": client_name,
+                    "setting_unique_id": setting.unique_id,
+                },
+            )
     else:
-        result = "Setting skipped"
+        outcome, result = Outcome.SKIPPED, "Setting skipped"
 
-    # add log entry
-    try:
-        supabase_logs.add_log_entry(client_name, setting, result)
-    except Exception:
-        result = f"Logging error: {traceback.format_exc()}"
+    # queue log entry, failures to store it are reported once on flush
+    logs.add_log_entry(client_name, setting, outcome, result)
 
     # add error to error list and setting
-    if "error" in result.lower():
-        errors[setting.get_hash()] = result
+    if outcome is Outcome.ERROR:
+        errors[setting.unique_id] = result
         setting.error = result
         setting.active = 0
-    elif "successfully" in result.lower():
+    elif outcome is Outcome.SUCCESS:
         setting.error = ""
 
 
-def check_setting_time(setting: Setting, last_time_sent: datetime | None):
+def check_setting_time(
+    setting: Setting, last_time_sent: datetime | None, now: datetime
+) -> tuple[Outcome, str] | None:
     """
     Check the setting time to determine if a message should be sent based
     on the last time it was sent.
@@ -177,29 +334,38 @@ def check_setting_time(setting: Setting, last_time_sent: datetime | None):
     - setting: Setting object to check against
     - last_time_sent: Datetime object representing the last time the message was sent,
         or None if never sent
+    - now: Timezone-aware datetime to check against
 
     Returns:
-    - str: Message indicating the result of the check, or None
-        if the message should be sent
+    - tuple[Outcome, str]: Outcome and message describing the result of the check,
+        or None if the message should be sent
     """
     if not last_time_sent:
-        return "Message was never sent before: logged successfully"
+        return Outcome.SUCCESS, "Message was never sent before: logged successfully"
 
     try:
-        should_be_run = setting.should_be_run(last_time_sent)
-        return None if should_be_run else "Message already sent recently"
+        if setting.should_be_run(last_time_sent, now):
+            return None
+        return Outcome.NOOP, "Message already sent recently"
     except Exception as e:
-        return f"Error: Could not figure out the crontab setting: {str(e)}"
+        return (
+            Outcome.ERROR,
+            f"Error: Could not figure out the crontab setting: {str(e)}",
+        )
 
 
-async def send_setting(setting: Setting, accounts: AccountCollection):
-    try:
-        from_chat_id, message_id = parse_telegram_message_url(setting.text)
-        forward_needed = True
-    except Exception:  # not a valid telegram url
-        forward_needed = False
+TELEGRAM_URL_PREFIXES = ("https://t.me/", "http://t.me/", "t.me/", "tg://")
+
 
-    acc: SenderAccount = accounts[setting.account]
+async def send_setting(setting: Setting, acc: SenderAccount) -> tuple[Outcome, str]:
+    # Only try to parse texts that look like links, plain messages
+    # would just raise inside the parser
+    forward_needed = setting.text.startswith(TELEGRAM_URL_PREFIXES)
+    if forward_needed:
+        try:
+            from_chat_id, message_id = parse_telegram_message_url(setting.text)
+        except Exception:  # not a valid telegram url
+            forward_needed = False
 
     try:
         if forward_needed:
@@ -208,11 +374,11 @@ async def send_setting(setting: Setting, accounts: AccountCollection):
                 from_chat_id=from_chat_id,
                 message_id=message_id,
             )
-            result = "Message forwarded successfully"
+            return Outcome.SUCCESS, "Message forwarded successfully"
 
         else:
             await acc.send_message(chat_id=setting.chat_id, text=setting.text)
-            result = "Message sent successfully"
+            return Outcome.SUCCESS, "Message sent successfully"
 
     except ChatWriteForbidden:
         result = "Error: Нет прав для отправки сообщения"
@@ -232,55 +398,59 @@ async def send_setting(setting: Setting, accounts: AccountCollection):
     except RPCError as e:
         result = f"Error sending message: {e}"
 
-    return result
+    return Outcome.ERROR, result
 
 
 ALERT_HEADING = "Результаты последней рассылки:"
 
 
-async def publish_stats(errors: dict, fs, client: Client):
+async def publish_stats(errors: dict[str, str], fs, client: Client):
     alert_acc = SenderAccount(fs, client.alert_account)
 
     async with alert_acc.session(revalidate=False):
-        # Send common errors like no accounts started
-        if "" in errors:
-            await alert_acc.send_message(chat_id=client.alert_chat, text=errors[""])
-
-        # Delete last message if it contains alert heading
-        app = alert_acc.app
-        last_msg: pyrogram.types.Message = await anext(
-            app.get_chat_history(chat_id=client.alert_chat, limit=1)
-        )
-        if last_msg.text and ALERT_HEADING in last_msg.text:
-            await app.delete_messages(
-                chat_id=client.alert_chat, message_ids=[last_msg.id]
-            )
+        await send_stats(errors, alert_acc, client)
 
-        # Calculate error stats from client.settings:
-        # turned off with errors, active with errors
 
-        stats_msg = prep_stats_msg(client)
+async def send_stats(errors: dict[str, str], alert_acc: SenderAccount, client: Client):
+    """Send alerts and stats to the alert chat through a started account."""
 
-        # Send error message
-        if stats_msg:
-            await alert_acc.send_message(chat_id=client.alert_chat, text=stats_msg)
+    # Send common errors like no accounts started
+    if "" in errors:
+        await alert_acc.send_message(chat_id=client.alert_chat, text=errors[""])
+
+    # Delete last message if it contains alert heading
+    app = alert_acc.app
+    last_msg: pyrogram.types.Message | None = await anext(
+        app.get_chat_history(chat_id=client.alert_chat, limit=1), None
+    )
+    if last_msg and last_msg.text and ALERT_HEADING in last_msg.text:
+        await app.delete_messages(chat_id=client.alert_chat, message_ids=[last_msg.id])
+
+    # Calculate error stats from client.settings:
+    # turned off with errors, active with errors
+
+    stats_msg = prep_stats_msg(client)
+
+    # Send error message
+    if stats_msg:
+        await alert_acc.send_message(chat_id=client.alert_chat, text=stats_msg)
 
     logger.warning("Alert message sent", extra={"errors": errors})
 
 
 def prep_stats_msg(client: Client):
-    turned_off_with_errors = len(
-        [s for s in client.settings if not s.active and s.error]
-    )
-    turned_off_no_errors = len(
-        [s for s in client.settings if not s.active and not s.error]
-    )
+    working = turned_off_with_errors = turned_off_no_errors = 0
+    for s in client.settings:
+        if s.active:
+            working += 1
+        elif s.error:
+            turned_off_with_errors += 1
+        else:
+            turned_off_no_errors += 1
 
     if not turned_off_with_errors and not turned_off_no_errors:
         return ""
 
-    working = len([s for s in client.settings if s.active])
-
     text = f"{ALERT_HEADING}\n\n"
 
     if turned_off_with_errors:
@@ -303,10 +473,52 @@ def prep_stats_msg(client: Client):
 
 app = Flask(__name__)
 
+# seconds, a bit under the container's 300 s execution timeout, so that
+# a hung run is cancelled here before the platform cuts the request off
+HANDLER_TIMEOUT = 280
+
+# Taken by the handler before a run is submitted and released by the run
+# itself once it has fully finished, cleanup included
+run_lock = threading.Lock()
+
+
+@cache
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    # One loop for the life of the process, shared by all requests
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+async def run_main():
+    try:
+        await main()
+    finally:
+        run_lock.release()
+
 
 @app.route("/", methods=["GET", "POST"])
 def handler():
-    asyncio.run(main())
+    # A mailing is already under way: answer at once instead of holding
+    # a worker thread until it finishes only to run the same queue again
+    if not run_lock.acquire(blocking=False):
+        return "Already running", 409
+
+    try:
+        future = asyncio.run_coroutine_threadsafe(run_main(), get_event_loop())
+    except Exception:
+        run_lock.release()
+        raise
+
+    try:
+        future.result(timeout=HANDLER_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # Cancel the run so it doesn't keep later requests out. The lock
+        # is released only after the run has unwound
+        future.cancel()
+        logger.error("Run timed out and was cancelled")
+        return "Timed out", 504
+
     return "OK"
 
 
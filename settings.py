@@ -1,6 +1,8 @@
+import enum
 import hashlib
-from datetime import datetime
+from datetime import datetime, timedelta
 from datetime import timezone as tz
+from functools import cached_property, lru_cache
 from os import error
 from zoneinfo import ZoneInfo
 
@@ -8,6 +10,15 @@ import croniter
 import pydantic
 
 
+class Outcome(enum.IntEnum):
+    """How processing a setting ended up"""
+
+    SUCCESS = enum.auto()  # message sent or logged as sent
+    ERROR = enum.auto()  # setting gets turned off
+    SKIPPED = enum.auto()  # setting is not active
+    NOOP = enum.auto()  # nothing to do yet
+
+
 class Setting(pydantic.BaseModel):
     active: int | bool
     account: str
@@ -43,25 +54,74 @@ class Setting(pydantic.BaseModel):
 
         return v
 
-    def should_be_run(self, last_run: datetime) -> bool:
+    def should_be_run(self, last_run: datetime, now: datetime | None = None) -> bool:
         # Check if the setting should be processed
         return self.active and check_cron_tz(
-            self.schedule, ZoneInfo("Europe/Moscow"), last_run, datetime.now(tz=tz.utc)
+            self.schedule,
+            CRONTAB_TZ,
+            last_run,
+            now or datetime.now(tz=tz.utc),
         )
 
-    def get_hash(self) -> str:
-        # Returns a 16-character hash that would be the same for the same setting
+    @cached_property
+    def unique_id(self) -> str:
+        # A 16-character hash that would be the same for the same setting.
+        # Computed once per setting, reset when the hashed fields change
         data = f"{self.account}_{self.chat_id}_{self.text}"
         return hashlib.blake2b(data.encode(), digest_size=8).hexdigest()
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in HASHED_FIELDS:
+            self.__dict__.pop("unique_id", None)
+
+    def model_copy(self, *, update=None, deep=False):
+        # pydantic copies `__dict__` as is, cached hash included,
+        # and writes updates past `__setattr__`
+        copy = super().model_copy(update=update, deep=deep)
+        if update and not update.keys().isdisjoint(HASHED_FIELDS):
+            copy.__dict__.pop("unique_id", None)
+        return copy
+
+
+HASHED_FIELDS = ("account", "chat_id", "text")
+
+# Schedules in the sheets are written in Moscow time
+CRONTAB_TZ = ZoneInfo("Europe/Moscow")
+
 
 def check_cron(crontab: str, last_run: datetime, now: datetime) -> bool:
     """Return True if, according to the crontab, there should have been
     another run between the last_run and now"""
 
-    cron = croniter.croniter(crontab, last_run)
-    next_run = cron.get_next(datetime)
-    return next_run <= now
+    # Cron has a one-minute resolution, so truncating `now` lets settings
+    # with the same schedule share a cached computation
+    minute = now.replace(second=0, microsecond=0)
+
+    # Nothing can have fired since a run made within the current minute
+    if last_run >= minute:
+        return False
+
+    return get_last_fire(crontab, minute) > last_run
+
+
+@lru_cache(maxsize=512)
+def get_last_fire(crontab: str, minute: datetime) -> datetime:
+    """Return the latest time, not later than `minute`, when the crontab fires"""
+
+    cron = get_croniter(crontab)
+    cron.set_current(minute + timedelta(minutes=1), force=True)
+    return cron.get_prev(datetime)
+
+
+@lru_cache(maxsize=128)
+def get_croniter(crontab: str) -> croniter.croniter:
+    """Return a croniter for the crontab, parsing each expression only once.
+
+    The instance is shared, so callers must set its current time before use.
+    """
+
+    return croniter.croniter(crontab)
 
 
 def check_cron_tz(
@@ -1,23 +1,31 @@
 import datetime
+import threading
 from logging import getLogger
 
 import supabase
+from more_itertools import chunked
+from postgrest import ReturnMethod
 from reretry import retry
 
 import settings
 
 logger = getLogger(__name__)
 
+LOG_BATCH_SIZE = 500  # rows per insert request
+
 
 class SupabaseLogHandler:
     def __init__(self, supabase_client: supabase.Client):
         self.supabase_client = supabase_client
+        self.cache = {}
+        self.pending = []
+        self.pending_lock = threading.Lock()  # `flush` runs in a worker thread
 
     @retry(tries=3)
     def load_results_for_client(self, client_name: str):
         """Calls the stored function "last_successful_entries"
         that returns 1 last successful entry for each setting_unique_id for a given client
-        and stores the results in the cache"""
+        and stores the results in the cache under the client name"""
 
         """
         Query to create the stored function:
@@ -27,30 +35,36 @@ class SupabaseLogHandler:
         AS $$
         select
         setting_unique_id, max(datetime) as datetime
-        from (select * from
-        log_entries
+        from log_entries
         where
         result like '%successfully%' and
         client_name = $1
-        order by datetime desc
-        ) as successful
         group by setting_unique_id;
         $$
+
+        Partial index that serves it without scanning the whole log:
+
+        create index if not exists log_entries_successful_idx
+        on log_entries (client_name, setting_unique_id, datetime desc)
+        where result like '%successfully%';
         """
 
         results = self.supabase_client.rpc(
             "last_successful_entries", {"client_name": client_name}
         ).execute()
 
-        self.cache = {row["setting_unique_id"]: row["datetime"] for row in results.data}
+        self.cache[client_name] = {
+            row["setting_unique_id"]: datetime.datetime.fromisoformat(row["datetime"])
+            for row in results.data
+        }
 
-    @retry(tries=3)
-    def get_last_successful_entry(self, setting: settings.Setting):
+    def get_last_successful_entry(self, client_name: str, setting: settings.Setting):
         """
         Retrieves the last successful log entry based on a given setting.
 
         Parameters:
             self (obj): The current instance of the class.
+            client_name (str): The client the setting belongs to.
             setting (settings.Setting): The setting object to retrieve
                 the last successful log entry for.
 
@@ -58,25 +72,55 @@ class SupabaseLogHandler:
             datetime.datetime: The datetime of the last successful entry if found, None otherwise.
         """
 
-        result = self.cache.get(setting.get_hash())
-        if result:
-            return datetime.datetime.fromisoformat(result)
+        return self.cache[client_name].get(setting.unique_id)
+
+    def add_log_entry(
+        self,
+        client_name: str,
+        setting: settings.Setting,
+        outcome: settings.Outcome,
+        result: str,
+    ):
+        """Queue a log entry. Entries are written to the database by `flush`."""
 
-    @retry(tries=3)
-    def add_log_entry(self, client_name: str, setting: settings.Setting, result: str):
-        # Save time by not writing `skipped` and `already sent`
-        # into the database
         entry = {
             "client_name": client_name,
             "account": setting.account,
             "chat_id": setting.chat_id,
             "result": result,
-            "setting_unique_id": setting.get_hash(),
+            "setting_unique_id": setting.unique_id,
         }
 
-        if "skipped" not in result and "already sent" not in result:
-            self.supabase_client.table("log_entries").insert(entry).execute()
+        # Save time by not writing `skipped` and `already sent`
+        # into the database
+        if outcome in (settings.Outcome.SUCCESS, settings.Outcome.ERROR):
+            with self.pending_lock:
+                self.pending.append(entry)
 
         # Log errors as warnings for easier search in the log
-        method = logger.warning if "error" in result.lower() else logger.info
+        method = logger.warning if outcome is settings.Outcome.ERROR else logger.info
         method(f"Logged {entry}", extra=entry)
+
+    def flush(self):
+        """Write all queued log entries with a single insert.
+
+        Safe to call from a worker thread: entries queued while the insert
+        is in flight are kept for the next flush."""
+        with self.pending_lock:
+            entries, self.pending = self.pending, []
+
+        for i, batch in enumerate(chunked(entries, LOG_BATCH_SIZE)):
+            try:
+                self.insert_entries(batch)
+            except Exception:
+                # Put the unwritten entries back ahead of the newer ones
+                with self.pending_lock:
+                    self.pending[:0] = entries[i * LOG_BATCH_SIZE :]
+                raise
+
+    @retry(tries=3)
+    def insert_entries(self, entries: list[dict]):
+        # Nothing reads the inserted rows back, so don't have them echoed
+        self.supabase_client.table("log_entries").insert(
+            entries, returning=ReturnMethod.minimal
+        ).execute()
@@ -0,0 +1,63 @@
+import asyncio
+import random
+import time
+
+from pyrogram.errors import FloodWait, InternalServerError, SlowmodeWait
+
+MAX_FLOOD_WAIT = 30  # seconds, longer waits are reported as errors
+
+
+async def call_with_retries(func, *args, tries=3, **kwargs):
+    """Await a Telegram API call, retrying transient failures:
+    waits out short FloodWaits and SlowmodeWaits and backs off exponentially
+    with jitter on Telegram internal server errors. Other errors propagate
+    at once.
+
+    Telegram does not say whether a wait is a short burst limit or a real
+    slow mode, so the duration decides: waits up to MAX_FLOOD_WAIT are slept
+    through, longer ones are raised and reported."""
+
+    for attempt in range(tries):
+        try:
+            return await func(*args, **kwargs)
+
+        except (FloodWait, SlowmodeWait) as e:
+            if attempt == tries - 1 or e.value > MAX_FLOOD_WAIT:
+                raise
+            delay = e.value
+
+        except InternalServerError:
+            if attempt == tries - 1:
+                raise
+            delay = 2**attempt * (1 + random.random() / 2)
+
+        await asyncio.sleep(delay)
+
+
+class RateLimiter:
+    """Token bucket pacing Telegram calls: on average `rate` calls
+    per second with bursts of up to `capacity` calls, and one call
+    per `chat_interval` seconds to the same chat."""
+
+    def __init__(self, rate: float = 25, capacity: int = 5, chat_interval: float = 3):
+        self.interval = 1 / rate
+        self.burst = (capacity - 1) * self.interval
+        self.chat_interval = chat_interval
+        self.next_slot = 0.0  # when the bucket is full again
+        self.next_chat_slots = {}
+
+    async def acquire(self, chat_id):
+        # Reserve the earliest free slot right away, so that concurrent
+        # callers queue up behind each other without a lock
+        now = time.monotonic()
+
+        # Take a token from the bucket, then wait for the chat to be free.
+        # Waiting for a chat does not hold back calls to other chats.
+        token_slot = max(now, self.next_slot - self.burst)
+        self.next_slot = max(self.next_slot, token_slot) + self.interval
+
+        slot = max(token_slot, self.next_chat_slots.get(chat_id, 0.0))
+        self.next_chat_slots[chat_id] = slot + self.chat_interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
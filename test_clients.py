@@ -0,0 +1,25 @@
+from clients import Client
+
+
+def test_check_for_duplicate_chat_ids(make_setting):
+    # Arrange
+    client = Client(
+        name="abc",
+        spreadsheet_url="https://example.com/spreadsheet",
+        alert_account="79234567890",
+        alert_chat="alerts",
+    )
+    client.settings = [
+        make_setting("chat_1", "Hello"),
+        make_setting("chat_2", "Hello"),
+        make_setting("chat_1", "Hello"),
+        make_setting("chat_1", "Hi"),
+    ]
+
+    # Act
+    client.check_for_duplicate_chat_ids()
+
+    # Assert
+    assert [s.active for s in client.settings] == [1, 1, 0, 1]
+    assert client.settings[2].error.startswith("Error")
+    assert not client.settings[0].error
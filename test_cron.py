@@ -89,6 +89,34 @@ def test_check_cron_happy_path(crontab, last_run, now, expected, _id):
             True,
             "ID010",
         ),
+        (
+            "0 * * * *",
+            datetime(2021, 1, 1, 10, 59, 30),
+            datetime(2021, 1, 1, 11, 0, 10),
+            True,
+            "ID010.1",
+        ),
+        (
+            "0 * * * *",
+            datetime(2021, 1, 1, 11, 0, 5),
+            datetime(2021, 1, 1, 11, 0, 50),
+            False,
+            "ID010.2",
+        ),
+        (
+            "* * * * *",
+            datetime(2021, 1, 1, 11, 0, 5),
+            datetime(2021, 1, 1, 11, 0, 50),
+            False,
+            "ID010.3",
+        ),
+        (
+            "* * * * *",
+            datetime(2021, 1, 1, 10, 59, 59),
+            datetime(2021, 1, 1, 11, 0, 1),
+            True,
+            "ID010.4",
+        ),
     ],
 )
 def test_check_cron_edge_cases(crontab, last_run, now, expected, _id):
@@ -0,0 +1,48 @@
+import pytest
+
+from settings import Setting
+
+
+@pytest.mark.parametrize(
+    "field, value, changed",
+    [
+        ("account", "79234567891", True),
+        ("chat_id", "chat_2", True),
+        ("text", "Hi", True),
+        ("error", "Error: something", False),
+        ("active", 0, False),
+    ],
+)
+def test_unique_id_after_assignment(make_setting, field, value, changed):
+    # Arrange
+    setting = make_setting()
+    old_id = setting.unique_id
+
+    # Act
+    setattr(setting, field, value)
+
+    # Assert
+    assert (setting.unique_id != old_id) == changed
+    assert setting.unique_id == Setting(**setting.model_dump()).unique_id
+
+
+@pytest.mark.parametrize(
+    "field, value, changed",
+    [
+        ("text", "Hi", True),
+        ("chat_id", "chat_2", True),
+        ("error", "Error: something", False),
+    ],
+)
+def test_unique_id_after_model_copy(make_setting, field, value, changed):
+    # Arrange
+    setting = make_setting()
+    old_id = setting.unique_id
+
+    # Act
+    copy = setting.model_copy(update={field: value})
+
+    # Assert
+    assert (copy.unique_id != old_id) == changed
+    assert copy.unique_id == Setting(**copy.model_dump()).unique_id
+    assert setting.unique_id == old_id
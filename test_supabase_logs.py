@@ -0,0 +1,47 @@
+import pytest
+
+from supabase_logs import LOG_BATCH_SIZE, SupabaseLogHandler
+
+
+def test_flush_requeues_failed_and_later_batches():
+    # Arrange
+    handler = SupabaseLogHandler(supabase_client=None)
+    handler.pending = [{"n": n} for n in range(LOG_BATCH_SIZE * 2 + 10)]
+    inserted = []
+
+    def insert_entries(batch):
+        if inserted:  # the second batch fails
+            raise ConnectionError("insert failed")
+        inserted.append(batch)
+
+    handler.insert_entries = insert_entries
+
+    # Act
+    with pytest.raises(ConnectionError):
+        handler.flush()
+
+    # Assert
+    assert inserted == [[{"n": n} for n in range(LOG_BATCH_SIZE)]]
+    assert handler.pending == [
+        {"n": n} for n in range(LOG_BATCH_SIZE, LOG_BATCH_SIZE * 2 + 10)
+    ]
+
+
+def test_flush_keeps_requeued_entries_ahead_of_newer_ones():
+    # Arrange
+    handler = SupabaseLogHandler(supabase_client=None)
+    handler.pending = [{"n": 1}, {"n": 2}]
+
+    def insert_entries(batch):
+        # An entry queued by another client while the insert is in flight
+        handler.pending.append({"n": 3})
+        raise ConnectionError("insert failed")
+
+    handler.insert_entries = insert_entries
+
+    # Act
+    with pytest.raises(ConnectionError):
+        handler.flush()
+
+    # Assert
+    assert handler.pending == [{"n": 1}, {"n": 2}, {"n": 3}]
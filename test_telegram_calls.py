@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+from pyrogram.errors import FloodWait, InternalServerError, SlowmodeWait
+
+import telegram_calls
+from telegram_calls import MAX_FLOOD_WAIT, RateLimiter, call_with_retries
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Freeze time.monotonic at 0 and record the sleeps instead of sleeping"""
+    sleeps = []
+
+    async def sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(telegram_calls.time, "monotonic", lambda: 0.0)
+    monkeypatch.setattr(telegram_calls.asyncio, "sleep", sleep)
+    return sleeps
+
+
+def acquire_all(limiter, chat_ids):
+    async def run():
+        for chat_id in chat_ids:
+            await limiter.acquire(chat_id)
+
+    asyncio.run(run())
+
+
+def test_rate_limiter_bursts_then_paces(clock):
+    # Arrange
+    limiter = RateLimiter(rate=10, capacity=3, chat_interval=0)
+
+    # Act
+    acquire_all(limiter, ["a", "b", "c", "d", "e"])
+
+    # Assert: three calls go out at once, the rest 0.1 s apart
+    assert clock == pytest.approx([0.1, 0.2])
+
+
+def test_rate_limiter_spaces_calls_to_the_same_chat(clock):
+    # Arrange
+    limiter = RateLimiter(rate=10, capacity=3, chat_interval=1)
+
+    # Act
+    acquire_all(limiter, ["a", "a", "b"])
+
+    # Assert: the second call to "a" waits for the chat,
+    # the call to "b" is not held back by it
+    assert clock == pytest.approx([1.0])
+
+
+def flaky_call(*errors):
+    """Return a fake API call that raises the errors one by one, then succeeds"""
+    calls = []
+
+    async def call():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return call, calls
+
+
+@pytest.mark.parametrize("error", [FloodWait, SlowmodeWait])
+def test_call_with_retries_sleeps_through_short_waits(clock, error):
+    # Arrange
+    call, calls = flaky_call(error(value=5))
+
+    # Act
+    result = asyncio.run(call_with_retries(call))
+
+    # Assert
+    assert result == "ok"
+    assert len(calls) == 2
+    assert clock == [5]
+
+
+def test_call_with_retries_raises_long_waits(clock):
+    # Arrange
+    call, calls = flaky_call(FloodWait(value=MAX_FLOOD_WAIT + 1))
+
+    # Act & Assert
+    with pytest.raises(FloodWait):
+        asyncio.run(call_with_retries(call))
+
+    assert len(calls) == 1
+    assert clock == []
+
+
+def test_call_with_retries_backs_off_on_server_errors(clock, monkeypatch):
+    # Arrange
+    monkeypatch.setattr(telegram_calls.random, "random", lambda: 0.5)
+    call, calls = flaky_call(InternalServerError(), InternalServerError())
+
+    # Act
+    result = asyncio.run(call_with_retries(call))
+
+    # Assert
+    assert result == "ok"
+    assert len(calls) == 3
+    assert clock == pytest.approx([1.25, 2.5])
+
+
+@pytest.mark.parametrize(
+    "error", [FloodWait(value=1), InternalServerError()], ids=["flood", "server"]
+)
+def test_call_with_retries_reraises_on_last_attempt(clock, error):
+    # Arrange
+    call, calls = flaky_call(error, error, error)
+
+    # Act & Assert
+    with pytest.raises(type(error)):
+        asyncio.run(call_with_retries(call, tries=3))
+
+    assert len(calls) == 3
+    assert len(clock) == 2